@@ -1,49 +1,54 @@
 import argparse
+import gzip
 import hashlib
+import hmac
+import html
+import io
 import json
 import os
+import posixpath
+import shutil
 import urllib.parse
 import urllib.request
 
-from collections.abc import Mapping, Sequence
-from string import Template
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 JETBRAINS_BASE_URL = 'https://data.services.jetbrains.com/products/releases'
 
-WHATSNEW_MAIN_TEMPLATE = Template("""<!DOCTYPE html><html lang="en">
+# Request headers for text responses (release JSON, checksums) that compress well on the wire.
+COMPRESSED_HEADERS = {'Accept-Encoding': 'gzip'}
+
+# Read/write buffer size used when streaming downloads and hashing files.
+CHUNK_SIZE = 1024 * 1024
+
+# The page is written as header, one article per release, then footer. Braces in the CSS are doubled for str.format().
+WHATSNEW_HEADER_TEMPLATE = """<!DOCTYPE html><html lang="en">
 <head>
 <meta charset="utf-8">
 <meta name="viewport" content="width=device-width, initial-scale=1.0">
-<title>$product - What's New</title>
+<title>{product} - What's New</title>
 <style>
-article header { margin-bottom: 1em; }
-article header h2 { margin-bottom: 0; }
-article:not(:last-child) { padding: 1em 0; border-bottom: 1px solid #ddd; }
-article section { margin-bottom: 1em; }
+article header {{ margin-bottom: 1em; }}
+article header h2 {{ margin-bottom: 0; }}
+article:not(:last-child) {{ padding: 1em 0; border-bottom: 1px solid #ddd; }}
+article section {{ margin-bottom: 1em; }}
 
-.subtitle { font-size: 0.9em; color: #666; margin-top: 0; }
+.subtitle {{ font-size: 0.9em; color: #666; margin-top: 0; }}
 </style>
 <body>
-<h1>What's New in $product</h1>
-$content
+<h1>What's New in {product}</h1>
+"""
+
+WHATSNEW_FOOTER = """
 </body>
 </html>
-""")
-
-WHATSNEW_ENTRY_TEMPLATE = Template("""<article>
-<header>
-<h2 id="$version">$version ($build)</h2>
-<span class="subtitle">$date</span>
-</header>
-<section>
-$whatsnew
-</section>
-<footer>
-<a href="$notesLink">Release Notes</a></div>
-</footer>
-</article>
-""")
+"""
 
 WHATSNEW_EMPTY_NOTES = 'No information provided.'
 
@@ -53,145 +58,209 @@ RaiseException = object()
 def get_item(obj, *keys, default=RaiseException):
     """Return a value in a nested dict and/or list via keys and indexes.
 
-    If `default` is RaiseException and an IndexError or KeyError exception occurs, the exception will be raised.
-    Otherwise, the `default` value will be returned if an IndexError or KeyError occur.
+    If `default` is RaiseException and an IndexError, KeyError or TypeError exception occurs, the exception will be
+    raised. Otherwise, the `default` value will be returned if an IndexError, KeyError or TypeError occur.
     """
-    if not isinstance(obj, (Mapping, Sequence)):
-        raise TypeError('Invalid mapping or sequence instance: {}'.format(obj))
-
-    NoMoreKeys = object()
-    keys = list(keys)
-
-    try:
-        key = keys.pop(0)
-    except IndexError:
-        key = NoMoreKeys
-
     current = obj
 
-    while key is not NoMoreKeys:
-        try:
+    try:
+        for key in keys:
             current = current[key]
-        except (KeyError, IndexError) as exc:
-            if default is RaiseException:
-                raise exc
-            return default
-
-        try:
-            key = keys.pop(0)
-        except IndexError:
-            key = NoMoreKeys
+    except (KeyError, IndexError, TypeError):
+        if default is RaiseException:
+            raise
+        return default
 
     return current
 
+
 def get_url_filename(url):
-    parsed_url = urllib.parse.urlparse(url)
-    return os.path.basename(parsed_url.path)
+    return posixpath.basename(urllib.parse.urlsplit(url).path)
+
+def prepare_output_file(url, destination):
+    """Create `destination` if needed and return the path `url` downloads to inside it.
+
+    The path is joined with os.path.join so it keeps the destination exactly as given (e.g. a leading `./`).
+    """
+    os.makedirs(destination, exist_ok=True)
+    return os.path.join(destination, get_url_filename(url))
 
 
 def download(url, destination):
-    filename = get_url_filename(url)
-    output_file = os.path.join(destination, filename)
+    output_file = prepare_output_file(url, destination)
 
     with open(output_file, 'wb') as fo, urllib.request.urlopen(url) as urlfo:
-        while True:
-            data = urlfo.read(1024)
-            if data:
-                fo.write(data)
-            else:
-                break
+        shutil.copyfileobj(urlfo, fo, length=CHUNK_SIZE)
     return output_file
 
-def read(url):
-    with urllib.request.urlopen(url) as urlfo:
-        return urlfo.read()
+def download_and_hash(url, destination):
+    """Download `url` into `destination` while computing its SHA-256.
+
+    Returns a tuple of the output file path and the raw digest of the downloaded data.
+    """
+    output_file = prepare_output_file(url, destination)
 
-def validate(filename, checksum_value):
     h = hashlib.sha256()
+    buf = bytearray(CHUNK_SIZE)
+    mv = memoryview(buf)
 
-    with open(filename, 'rb') as fi:
-        while True:
-            data = fi.read(1024)
-            if data:
-                h.update(data)
-            else:
-                break
-    return checksum_value == h.hexdigest()
+    with open(output_file, 'wb') as fo, urllib.request.urlopen(url) as urlfo:
+        while n := urlfo.readinto(buf):
+            chunk = mv[:n]
+            fo.write(chunk)
+            h.update(chunk)
+    return output_file, h.digest()
+
+def decoded(urlfo):
+    """Return a file object yielding the decompressed body of a response fetched with `COMPRESSED_HEADERS`."""
+    if urlfo.headers.get('Content-Encoding') == 'gzip':
+        return gzip.GzipFile(fileobj=urlfo)
+    return urlfo
+
+def load_json(fp):
+    """Parse JSON from `fp`, using orjson when it is installed and the stdlib json module otherwise."""
+    if orjson is not None:
+        return orjson.loads(fp.read())
+    return json.load(fp)
+
+def read(url, max_bytes=1024 * 1024):
+    """Return the body of `url`, raising ValueError if it is larger than `max_bytes`."""
+    with urllib.request.urlopen(urllib.request.Request(url, headers=COMPRESSED_HEADERS)) as urlfo:
+        content_length = urlfo.headers.get('Content-Length')
+        if content_length and int(content_length) > max_bytes:
+            raise ValueError('Response from {} exceeds {} bytes'.format(url, max_bytes))
+
+        data = decoded(urlfo).read(max_bytes + 1)
+        if len(data) > max_bytes:
+            raise ValueError('Response from {} exceeds {} bytes'.format(url, max_bytes))
+        return data
+
+def checksum_matches(checksum_value, digest):
+    """Compare a hex `checksum_value` against a raw `digest` in constant time.
+
+    A malformed checksum value never matches.
+    """
+    try:
+        expected = bytes.fromhex(checksum_value)
+    except ValueError:
+        return False
+    return hmac.compare_digest(expected, digest)
 
 
 def generate_whatsnew(name, releases):
-    entries = []
+    """Return the "What's New" HTML page for `releases`.
+
+    Release fields are HTML-escaped, with missing or null fields rendered as empty strings; the `whatsnew` notes are
+    already HTML and are inserted as-is. Releases without a `notesLink` get no "Release Notes" link.
+    """
+    esc = html.escape
+    buf = io.StringIO()
+    write = buf.write
+    write(WHATSNEW_HEADER_TEMPLATE.format(product=esc(name)))
 
     for release in releases:
+        version = esc(release.get('version') or '')
+        build = esc(release.get('build') or '')
+        date = esc(release.get('date') or '')
+        notes_link = release.get('notesLink')
         whatsnew = release.get('whatsnew')
 
         if whatsnew is None or whatsnew.strip() == '':
-            release['whatsnew'] = WHATSNEW_EMPTY_NOTES
+            whatsnew = WHATSNEW_EMPTY_NOTES
 
-        entry = WHATSNEW_ENTRY_TEMPLATE.substitute(**release)
-        entries.append(entry)
+        if notes_link:
+            notes_link = f'<a href="{esc(notes_link)}">Release Notes</a>'
+        else:
+            notes_link = ''
 
-    return WHATSNEW_MAIN_TEMPLATE.substitute(product=name, content=''.join(entries))
+        write(f"""<article>
+<header>
+<h2 id="{version}">{version} ({build})</h2>
+<span class="subtitle">{date}</span>
+</header>
+<section>
+{whatsnew}
+</section>
+<footer>
+{notes_link}</div>
+</footer>
+</article>
+""")
+
+    write(WHATSNEW_FOOTER)
+    return buf.getvalue()
 
 
 def main(command, code, name=None, version=None, build=None, latest=False, **kwargs):
-    code = code.upper()
-    
-    params = dict(code=code.upper(),
-                  type='release',
-                  latest='true' if latest else 'false')
-    
-    encoded_params = urllib.parse.urlencode(params)
-    url = f'{JETBRAINS_BASE_URL}?{encoded_params}'
-
-    with urllib.request.urlopen(url) as urlfio:
-        releases = json.loads(urlfio.read())
+    # version and build accept a comma-separated list of codes, all fetched with one request.
+    codes = [c.strip() for c in code.upper().split(',') if c.strip()]
+    if not codes:
+        print('No product code given', file=sys.stderr)
+        return 1
+    if len(codes) > 1 and command not in ('version', 'build'):
+        print('Multiple product codes are only supported by version and build', file=sys.stderr)
+        return 1
+    code = ','.join(codes)
+
+    url = f'{JETBRAINS_BASE_URL}?code={urllib.parse.quote(code, safe=",")}&type=release&latest={"true" if latest else "false"}'
+
+    with urllib.request.urlopen(urllib.request.Request(url, headers=COMPRESSED_HEADERS)) as urlfio:
+        releases = load_json(decoded(urlfio))
+
+    unknown = [c for c in codes if not releases.get(c)]
+    if unknown:
+        print('No releases found for product code: {}'.format(', '.join(unknown)), file=sys.stderr)
+        return 1
 
     if command in ('version', 'build'):
-        result = releases[code][0].get(command, '')
-        print(result)
+        for product_code in codes:
+            result = releases[product_code][0].get(command, '')
+            print(result)
     elif command in ('download', 'download_url', 'checksum', 'checksum_url'):
-        match = False
         get_first_match = not (version or build)
-        for release in releases[code]:
-            if get_first_match or (version and release['version'] == version) or (build and release['build'] == build):
-                match = True
-
-            if match:
-                if command in ('download', 'download_url'):
-                    download_url = get_item(release, 'downloads', 'linux', 'link')
-                    if command == 'download':
-                        dest = kwargs.get('dest') or '.'
-                        filename = download(download_url, dest)
-                        if not kwargs.get('skip_validation', False):
-                            checksum_url = get_item(release, 'downloads', 'linux', 'checksumLink')
-                            data = read(checksum_url) 
-                            checksum_value = data.decode().strip().split()[0]
-                            if not validate(filename, checksum_value):
-                                print('Checksum validation failed', file=sys.stderr)
-                                return 2
-                        print(filename)
-                    elif command == 'download_url':
-                        print(download_url)
-                elif command in ('checksum', 'checksum_url'):
-                    checksum_url = get_item(release, 'downloads', 'linux', 'checksumLink')
-                    if command == 'checksum':
-                        dest = kwargs.get('dest')
-                        if dest:
-                            filename = download(checksum_url, dest)
-                            print(filename)
-                        else:
-                            data = read(checksum_url) 
-                            print(data.decode().strip())
-                    elif command == 'checksum_url':
-                        print(checksum_url)
-                break
-        else:
+        release = next((r for r in releases[code]
+                        if get_first_match or
+                        (version and r.get('version') == version) or
+                        (build and r.get('build') == build)), None)
+
+        if release is None:
             print('Could not find matching release', file=sys.stderr)
             return 1
+
+        if command in ('download', 'download_url'):
+            download_url = get_item(release, 'downloads', 'linux', 'link')
+            if command == 'download':
+                dest = kwargs.get('dest') or '.'
+                if kwargs.get('skip_validation', False):
+                    filename = download(download_url, dest)
+                else:
+                    checksum_url = get_item(release, 'downloads', 'linux', 'checksumLink')
+                    # Fetch the checksum while the installer downloads.
+                    with ThreadPoolExecutor(max_workers=1) as executor:
+                        checksum_future = executor.submit(read, checksum_url)
+                        filename, digest = download_and_hash(download_url, dest)
+                        data = checksum_future.result()
+                    checksum_value = data.decode().strip().split()[0]
+                    if not checksum_matches(checksum_value, digest):
+                        print('Checksum validation failed', file=sys.stderr)
+                        return 2
+                print(filename)
+            elif command == 'download_url':
+                print(download_url)
+        elif command in ('checksum', 'checksum_url'):
+            checksum_url = get_item(release, 'downloads', 'linux', 'checksumLink')
+            if command == 'checksum':
+                dest = kwargs.get('dest')
+                if dest:
+                    filename = download(checksum_url, dest)
+                    print(filename)
+                else:
+                    data = read(checksum_url) 
+                    print(data.decode().strip())
+            elif command == 'checksum_url':
+                print(checksum_url)
     elif command == 'generate_whatsnew':
-        product_name = kwargs.get('name')
-        output = generate_whatsnew(product_name, releases[code])
+        output = generate_whatsnew(name, releases[code])
         print(output)
     return 0
 
@@ -205,10 +274,10 @@ if __name__ == '__main__':
     subparsers = parser.add_subparsers(dest='command', help='Subcommand', required=True)
 
     version_parser = subparsers.add_parser('version', help='Print the latest version')
-    version_parser.add_argument('-c', '--code', required=True, help='Product code')
+    version_parser.add_argument('-c', '--code', required=True, help='Product code, or comma-separated product codes (one line is printed per code, in the order given)')
 
     build_parser = subparsers.add_parser('build', help='Print the latest build')
-    build_parser.add_argument('-c', '--code', required=True, help='Product code')
+    build_parser.add_argument('-c', '--code', required=True, help='Product code, or comma-separated product codes (one line is printed per code, in the order given)')
 
     download_parser = subparsers.add_parser('download', help='Download the version or build specified')
     download_parser.add_argument('-c', '--code', required=True, help='Product code')
@@ -248,5 +317,5 @@ if __name__ == '__main__':
              (args.version, args.build).count(None) == 2)):
         latest = True
 
-    sys.exit(main(**vars(args)))
+    sys.exit(main(latest=latest, **vars(args)))
 